@@ -469,7 +469,7 @@ class ESI(object):
         return auth_headers
 
     def _check_key(self, key: str) -> None:
-        if key not in self._metadata.paths:
+        if key not in self._metadata:
             raise ValueError(f"{key} is not a valid request key.")
 
     def _check_method(self, api_request: ESIRequest, method: str) -> None:
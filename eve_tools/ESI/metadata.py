@@ -1,6 +1,12 @@
+import filecmp
+import json
+import logging
 import os
+import pickle
 import requests
-import json
+import sys
+import tempfile
+import threading
 from typing import Any, List, Optional
 from dataclasses import dataclass, field
 
@@ -9,8 +15,203 @@ from eve_tools.config import METADATA_PATH
 from .param import ESIParams, Param
 from .token import Token
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to ijson or stdlib json
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # ijson is optional
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+METADATA_URL = "https://esi.evetech.net/latest/swagger.json?datasource=tranquility"
+METADATA_ETAG_PATH = METADATA_PATH + ".etag"
+# Parsed metadata, see ESIMetadata._dump_pickle().
+METADATA_PICKLE_PATH = METADATA_PATH + ".pkl"
+
+# Parsed metadata shared by all ESIMetadata instances, populated on first load.
+_CACHED = {
+    "templates": None,
+    "invalid": None,
+    "sec": None,
+    "metaParams": None,
+    "metaParamIndex": None,
+    "paths": None,
+    "stamp": None,
+}
+
+# Format of METADATA_PICKLE_PATH.
+# Bump when Param, ESIParams, or the pickled fields change, so old pickle files are ignored.
+_PICKLE_FORMAT = 1
+
+
+# Top level fields of metadata used by ESIMetadata.
+# Others, such as "definitions", are large and not needed.
+METADATA_FIELDS = ("paths", "parameters", "securityDefinitions")
+
+
+def _parse_metadata(metadata_file) -> dict:
+    """Parse fields in METADATA_FIELDS from a metadata file opened in binary mode.
+
+    orjson is used if available, since it parses the whole file faster than
+    building objects from ijson events.
+    Otherwise, if ijson with its C backend is available, metadata is streamed and unused fields
+    are skipped without building Python objects for them.
+    Otherwise the whole file is parsed with json.
+
+    Raises:
+        ValueError: Metadata is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(metadata_file.read())
+    if ijson is None or ijson.backend != "yajl2_c":
+        return json.loads(metadata_file.read())
+
+    metadata = {}
+    field_ = None
+    builder = None
+    try:
+        for prefix, event, value in ijson.parse(metadata_file, use_float=True):
+            if prefix == "":  # top level map_key or end_map
+                if builder is not None:
+                    metadata[field_] = builder.value
+                    builder = None
+                if event == "map_key" and value in METADATA_FIELDS:
+                    field_ = value
+                    builder = ijson.ObjectBuilder()
+            elif builder is not None:
+                builder.event(event, value)
+    except ijson.JSONError as exc:
+        raise ValueError(f"Metadata is not valid JSON: {exc}") from exc
+    return metadata
+
+
+def _intern_metadata(metadata: dict) -> None:
+    """Intern repeated strings of parameters and security scopes in metadata in place.
+
+    Values such as "query", "integer", "character_id", "esi-markets.structure_markets.v1"
+    repeat across hundreds of paths. Interning keeps one copy of each.
+    Keys are already shared by the json parser.
+    """
+    intern = sys.intern
+
+    def intern_param(param: dict) -> None:
+        for k in ("name", "in", "type"):
+            v = param.get(k)
+            if isinstance(v, str):
+                param[k] = intern(v)
+
+    for param in metadata["parameters"].values():
+        intern_param(param)
+
+    for methods in metadata["paths"].values():
+        for body in methods.values():
+            for param in body.get("parameters", ()):
+                intern_param(param)
+            for security in body.get("security", ()):
+                for name, scopes in security.items():
+                    security[name] = [intern(scope) for scope in scopes]
+
+
+def _metadata_stamp(metadata_file=None) -> tuple:
+    """Stamp of local metadata file and pickle format, which changes when either changes.
+
+    If an opened metadata_file is given, stamp of that file is returned,
+    even if local metadata file has been replaced after opening.
+    """
+    if metadata_file is None:
+        stat = os.stat(METADATA_PATH)
+    else:
+        stat = os.fstat(metadata_file.fileno())
+    return (_PICKLE_FORMAT, stat.st_mtime_ns, stat.st_size)
+
+
+def _read_etag() -> Optional[str]:
+    """Read ETag of local metadata file. Returns None if ETag is not recorded."""
+    if not os.path.exists(METADATA_ETAG_PATH):
+        return None
+    with open(METADATA_ETAG_PATH) as etag_file:
+        return etag_file.read().strip() or None
+
+
+def _download_metadata(etag: Optional[str] = None, **kwd) -> bool:
+    """Stream metadata from EVE website to local metadata file.
+
+    Response is written in chunks to a unique temporary file, which then replaces local file,
+    so local file never holds a partially downloaded file, even if several processes download at once.
+    Local file is kept untouched if the downloaded file has the same content.
+    ETag of the response is recorded in METADATA_ETAG_PATH.
+
+    Args:
+        etag: str
+            ETag of local metadata file. If given, a conditional request is sent,
+            and nothing is downloaded if metadata is not modified.
+        kwd:
+            Keywords passed to requests.get.
+
+    Returns:
+        A bool indicating if local metadata file is rewritten.
+
+    Raises:
+        ValueError: Metadata downloaded is empty.
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(METADATA_PATH), prefix=".metadata-", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as metadata_file:
+            with requests.get(METADATA_URL, headers=headers, stream=True, **kwd) as r:
+                if r.status_code == 304:  # Not Modified
+                    return False
+                r.raise_for_status()
+                for chunk in r.iter_content(65536):
+                    metadata_file.write(chunk)
+                new_etag = r.headers.get("ETag")
+
+        if os.stat(tmp_path).st_size == 0:
+            raise ValueError("Metadata is empty.")
+
+        modified = not (
+            os.path.exists(METADATA_PATH)
+            and filecmp.cmp(tmp_path, METADATA_PATH, shallow=False)
+        )
+        if modified:
+            os.replace(tmp_path, METADATA_PATH)
+            if os.path.exists(METADATA_PICKLE_PATH):
+                os.remove(METADATA_PICKLE_PATH)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if new_etag:
+        with open(METADATA_ETAG_PATH, "w") as etag_file:
+            etag_file.write(new_etag)
+    elif modified and os.path.exists(METADATA_ETAG_PATH):
+        os.remove(METADATA_ETAG_PATH)
+    return modified
+
+
+def _refresh_metadata() -> None:
+    """Revalidate local metadata file with EVE website, and rewrite it if it changed.
+
+    Runs in a background thread, so errors are logged and local file is kept.
+    New metadata takes effect the next time metadata is loaded from local file.
+    """
+    try:
+        _download_metadata(_read_etag(), timeout=30)
+    except Exception as exc:
+        logger.warning("Failed to refresh metadata: %s", exc)
+
+
+# dataclass(slots=True) is available in python 3.10+.
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
 
-@dataclass
+@dataclass(**_SLOTS)
 class ESIRequest:
     """Holds information of a request to ESI.
 
@@ -18,6 +219,7 @@ class ESIRequest:
     with request_key, request_type, parameters, and security set.
     The ESI class uses the ESIRequest got from ESIMetadata to perform parameter parse and check,
     and fill in the url, headers, params field.
+    ESIRequest uses __slots__ on python 3.10+, so attributes other than the fields below can't be set.
 
     Args:
         request_key: str
@@ -60,7 +262,7 @@ class ESIRequest:
 class ESIMetadata(object):
     """Holds and parse metadata from EVE ESI.
 
-    Retrieve metadata from either ESI or local file.
+    Retrieve metadata from either ESI or local file on first use.
     Parses metadata into ESIRequest for a given key in getitem method.
 
     EVE ESI provides metadata for swagger clients.
@@ -70,48 +272,78 @@ class ESIMetadata(object):
     """
 
     def __init__(self):
-        self.paths = None
         self.securityDefinitions = None
 
         self._metaParams = None  # params that exist in metadata["parameters"]
-        self._load_metadata()
+        self._metaParamIndex = None  # {Param.name: Param} of self._metaParams
+        self._templates = None  # {key: (request_type, parameters, security)}
+        self._invalid = None  # {key: error message} for unsupported requests
+        self._paths = None  # metadata["paths"], see paths property
+        self._stamp = None  # stamp of local metadata file the above are parsed from
+        # Metadata is loaded on first use, see _ensure_loaded().
+
+    @property
+    def paths(self) -> dict:
+        """The "paths" field of metadata.
+
+        Parsed requests are used by ESIMetadata, so raw paths are not kept in the pickle file.
+        If metadata is loaded from the pickle file, paths is parsed from local file on first access.
+        If local file has been refreshed since then, all metadata is parsed again from it,
+        so that paths always matches parsed requests.
+        """
+        self._ensure_loaded()
+        if self._paths is None:
+            with open(METADATA_PATH, "rb") as metadata_file:
+                if _metadata_stamp(metadata_file) == self._stamp:
+                    self._paths = _parse_metadata(metadata_file)["paths"]
+            if self._paths is None:
+                self._parse_metadata_file()
+                self._dump_pickle(self._stamp)
+                self._store_cache()
+            elif _CACHED["stamp"] == self._stamp:
+                _CACHED["paths"] = self._paths
+        return self._paths
 
     def __getitem__(self, key: str) -> ESIRequest:
         """Get an ESIRequest with key.
 
-        Parse and find metadata entry with the given key.
+        Find parsed metadata entry with the given key.
         Assume each metadata entry is ONE of GET, POST.
         Some ESI API has DELETE or PUT, such as /characters/{character_id}/contacts/,
         but they tend to be trivial in market data analysis, so they are not supported.
 
+        Parameters and security of every key are parsed when metadata is loaded.
+        A new ESIRequest is returned on every call, because ESI fills in url, headers, params of it.
+
         Returns:
             An ESIRequest instance with request_key = key.
 
         Raises:
             KeyError: key is not a valid request type.
+            ValueError: API request with multiple scopes is not supported.
         """
-        if not key in self.paths.keys():
+        self._ensure_loaded()
+        template = self._templates.get(key)
+        if template is None:
+            if key in self._invalid:
+                raise ValueError(self._invalid[key])
             raise KeyError(f"{key} is not a valid request type.")
 
-        request_key = key
-        request_type = list(self.paths[key].keys())
-        if len(request_type) > 1:
-            # log warning
-            # find "get" or "post" method
-            for t in request_type:
-                if t == "get" or t == "post":
-                    request_type = t
-
-        request_type = request_type[0]
-        request_body = self.paths[key][request_type]
-        parameters = self._parse_parameters(request_body)
-        security = self._parse_security(request_body)
-
-        return ESIRequest(request_key, request_type, parameters, security)
+        request_type, parameters, security = template
+        return ESIRequest(key, request_type, parameters, security)
 
     def __setitem__(self, key: Any, value: Any):
         raise TypeError("ESIMetadata is not writable")
 
+    def __contains__(self, key: str) -> bool:
+        self._ensure_loaded()
+        return key in self._templates or key in self._invalid
+
+    def _ensure_loaded(self) -> None:
+        """Load metadata if it has not been loaded by this instance."""
+        if self._templates is None:
+            self._load_metadata()
+
     def _parse_parameters(self, body: dict) -> ESIParams:
         """Parse parameters of the metadata for a request.
 
@@ -120,22 +352,23 @@ class ESIMetadata(object):
         Returns:
             An ESIParams instance with all Param(s) instanciated.
         """
-        parameters = body["parameters"]
+        meta = self._metaParamIndex
         params = []
-        for param in parameters:
+        append = params.append
+        for param in body["parameters"]:
             # check for {$ref : #/parameters/xxx} type param
             # Parameters defined in metadata["parameters"] has key pattern: "$ref/parameters/xxx".
             # Ignore parameters with $ref/parameters signature but not in metadata["parameters"] field.
-            metaparam = param.get("$ref", "")  # $ref for meta parameters
+            metaparam = param.get("$ref")  # $ref for meta parameters
             if metaparam:
-                param_ = self._metaParams[metaparam.split("/")[-1]]
+                param_ = meta.get(metaparam.rpartition("/")[2])
                 if param_:
-                    params.append(param_)
+                    append(param_)
                 continue
 
             # construct Param class
             # Param.default is only present in meta parameters.
-            params.append(
+            append(
                 Param(
                     param["name"],
                     param["in"],
@@ -175,29 +408,78 @@ class ESIMetadata(object):
     def _load_metadata(self) -> None:
         """Load metadata from local file or EVE website.
 
-        Synchronous request from EVE website if local file is not valid.
+        Metadata is parsed once per process and shared by all ESIMetadata instances.
+        Synchronous request from EVE website if local file is missing, empty, or not valid JSON.
+        Otherwise the local file is used right away, and a background thread
+        refreshes the local file for the next process.
+        Parsed metadata is pickled next to local file, so later processes skip parsing.
 
         Raises:
-            ValueError: Metadata is empty when loading from local file or EVE website.
+            ValueError: Metadata is empty or not valid JSON when loading from local file or EVE website.
         """
-        metadata = None
-        if not os.path.exists(METADATA_PATH) or os.stat(METADATA_PATH).st_size == 0:
-            r = requests.get(
-                "https://esi.evetech.net/latest/swagger.json?datasource=tranquility"
-            )
-            r.raise_for_status()
-            metadata = r.json()
-            with open(METADATA_PATH, "w") as metadata_file:
-                json.dump(metadata, metadata_file)
-        else:
-            with open(METADATA_PATH) as metadata_file:
-                metadata = json.load(metadata_file)
+        if _CACHED["templates"] is not None:
+            self._templates = _CACHED["templates"]
+            self._invalid = _CACHED["invalid"]
+            self.securityDefinitions = _CACHED["sec"]
+            self._metaParams = _CACHED["metaParams"]
+            self._metaParamIndex = _CACHED["metaParamIndex"]
+            self._paths = _CACHED["paths"]
+            self._stamp = _CACHED["stamp"]
+            return
+
+        has_local_file = (
+            os.path.exists(METADATA_PATH) and os.stat(METADATA_PATH).st_size > 0
+        )
+        if not has_local_file:
+            _download_metadata()
+
+        if not self._load_pickle(_metadata_stamp()):
+            try:
+                self._parse_metadata_file()
+            except ValueError as exc:
+                if not has_local_file:
+                    raise
+                logger.warning("Local metadata is invalid, downloading again: %s", exc)
+                _download_metadata()
+                has_local_file = False  # just downloaded, no need to refresh
+                self._parse_metadata_file()
+            self._dump_pickle(self._stamp)
+
+        if has_local_file:
+            threading.Thread(target=_refresh_metadata, daemon=True).start()
+
+        self._store_cache()
+
+    def _store_cache(self) -> None:
+        """Share metadata of this instance with ESIMetadata instances created later."""
+        _CACHED["templates"] = self._templates
+        _CACHED["invalid"] = self._invalid
+        _CACHED["sec"] = self.securityDefinitions
+        _CACHED["metaParams"] = self._metaParams
+        _CACHED["metaParamIndex"] = self._metaParamIndex
+        _CACHED["paths"] = self._paths
+        _CACHED["stamp"] = self._stamp
+
+    def _parse_metadata_file(self) -> None:
+        """Parse local metadata file into securityDefinitions, meta params, and parsed requests.
+
+        Stamp of the parsed file is recorded in self._stamp.
+
+        Raises:
+            ValueError: Metadata is empty or not valid JSON.
+        """
+        with open(METADATA_PATH, "rb") as metadata_file:
+            stamp = _metadata_stamp(metadata_file)
+            metadata = _parse_metadata(metadata_file)
 
         if not metadata or not metadata.keys():
             raise ValueError("Metadata is empty.")
 
+        _intern_metadata(metadata)
+
+        self._stamp = stamp
         self.securityDefinitions = metadata["securityDefinitions"]
-        self.paths = metadata["paths"]
+        self._paths = metadata["paths"]
 
         params = [
             Param(
@@ -210,6 +492,93 @@ class ESIMetadata(object):
             for v in metadata["parameters"].values()
         ]
         self._metaParams = ESIParams(params)
+        self._metaParamIndex = {p.name: p for p in params}
+
+        # Select one method for each path: "get", then "post", then whatever is first.
+        self._templates = {}
+        self._invalid = {}
+        for key, methods in self._paths.items():
+            request_type = (
+                "get"
+                if "get" in methods
+                else ("post" if "post" in methods else next(iter(methods)))
+            )
+            request_body = methods[request_type]
+            try:
+                security = self._parse_security(request_body)
+            except ValueError as exc:
+                self._invalid[key] = str(exc)
+                continue
+            parameters = self._parse_parameters(request_body)
+            self._templates[key] = (request_type, parameters, security)
+
+    def _load_pickle(self, stamp: tuple) -> bool:
+        """Load parsed metadata from METADATA_PICKLE_PATH.
+
+        Args:
+            stamp: tuple
+                Stamp of local metadata file, returned by _metadata_stamp().
+
+        Returns:
+            A bool indicating if parsed metadata is loaded.
+            False if pickle file is missing, broken, or made from a different metadata file.
+        """
+        try:
+            with open(METADATA_PICKLE_PATH, "rb") as pickle_file:
+                pickled = pickle.load(pickle_file)
+        except Exception:
+            return False
+
+        if not isinstance(pickled, dict) or pickled.get("stamp") != stamp:
+            return False
+
+        self._templates = pickled["templates"]
+        self._invalid = pickled["invalid"]
+        self.securityDefinitions = pickled["sec"]
+        self._metaParams = pickled["metaParams"]
+        self._metaParamIndex = pickled["metaParamIndex"]
+        self._paths = None
+        self._stamp = stamp
+        return True
+
+    def _dump_pickle(self, stamp: tuple) -> None:
+        """Save parsed metadata to METADATA_PICKLE_PATH, keyed by stamp of local metadata file.
+
+        Only parsed requests and meta params are saved. Raw paths hold every response schema,
+        and loading them is about as slow as parsing local file.
+        """
+        pickled = {
+            "stamp": stamp,
+            "templates": self._templates,
+            "invalid": self._invalid,
+            "sec": self.securityDefinitions,
+            "metaParams": self._metaParams,
+            "metaParamIndex": self._metaParamIndex,
+        }
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(METADATA_PICKLE_PATH),
+                prefix=".metadata-",
+                suffix=".tmp",
+            )
+            with os.fdopen(fd, "wb") as pickle_file:
+                pickle.dump(pickled, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, METADATA_PICKLE_PATH)
+        except OSError as exc:
+            logger.warning("Failed to save parsed metadata: %s", exc)
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def reload(cls) -> None:
+        """Clears metadata shared by ESIMetadata instances.
+
+        The next ESIMetadata instance loads metadata again. Used for testing.
+        """
+        for k in _CACHED:
+            _CACHED[k] = None
 
     # Helpful functions
 
@@ -235,25 +604,24 @@ class ESIMetadata(object):
                 Select parameters with or without a default value.
                 Default not filtering based on "default" field.
         """
-        error_header_printed = False
-        ins = []  # hold results
-        for key in self.paths.keys():
-            try:
-                for param in self.__getitem__(key).parameters:
-                    if (
-                        (_in and param._in != _in)
-                        or param.name in ins
-                        or (required is not None and param.required != required)
-                        or (default and not param.default)
-                    ):
-                        continue
-                    ins.append(param.name)
-            except KeyError:
-                if not error_header_printed:
-                    print("Invalid APIs that does not follow filters: ")
-                    error_header_printed = True
+        self._ensure_loaded()
+        seen = set()  # names already accepted
+        ins = []  # hold results in order
+        for _, parameters, _ in self._templates.values():
+            for param in parameters:
+                if (
+                    (_in and param._in != _in)
+                    or param.name in seen
+                    or (required is not None and param.required != required)
+                    or (default and not param.default)
+                ):
+                    continue
+                seen.add(param.name)
+                ins.append(param.name)
+        if self._invalid:
+            print("Invalid APIs that does not follow filters: ")
+            for key in self._invalid:
                 print("\t", key)
-                continue
         print(f"Names filtered for {_in}:")
         for i in ins:
             print(f"\t{i}")
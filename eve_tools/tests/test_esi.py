@@ -1,15 +1,21 @@
+import json
+import os
+import pickle
+import tempfile
 import unittest
 from aiohttp import ClientResponseError
 from datetime import datetime
+from unittest import mock
 
 from eve_tools.ESI import ESIClient
+from eve_tools.ESI import metadata as esi_metadata
 from eve_tools.ESI.metadata import ESIMetadata, ESIRequest
 from eve_tools.ESI.utils import _SessionRecord, ESIRequestError
 from eve_tools.ESI.esi import _RequestChecker
 from eve_tools.ESI.sso.utils import to_clipboard, read_clipboard
 from eve_tools.data import CacheDB
 from eve_tools.data.cache import SqliteCache
-from eve_tools.tests.utils import request_from_ESI
+from eve_tools.tests.utils import request_from_ESI, FakeResponse
 
 
 class TestESI(unittest.TestCase):
@@ -240,6 +246,354 @@ class TestRequestChecker(unittest.TestCase):
         self.assertFalse(res)
 
 
+class TestMetadata(unittest.TestCase):
+    metadata = ESIMetadata()
+
+    def test_getitem(self):
+        """Tests ESIMetadata.__getitem__()."""
+        api_request = self.metadata["/markets/{region_id}/orders/"]
+        self.assertIsInstance(api_request, ESIRequest)
+        self.assertEqual(api_request.request_type, "get")
+
+        # get, post, put, delete: "get" is selected
+        api_request = self.metadata["/characters/{character_id}/contacts/"]
+        self.assertEqual(api_request.request_type, "get")
+
+        api_request = self.metadata["/universe/names/"]
+        self.assertEqual(api_request.request_type, "post")
+
+        with self.assertRaises(KeyError):
+            self.metadata["/not/a/request/"]
+
+
+# A small swagger.json with the fields ESIMetadata uses.
+SWAGGER = {
+    "definitions": {"unused": {"type": "object"}},
+    "parameters": {
+        "datasource": {
+            "name": "datasource",
+            "in": "query",
+            "type": "string",
+            "default": "tranquility",
+        },
+        "page": {"name": "page", "in": "query", "type": "integer", "default": 1},
+    },
+    "securityDefinitions": {"evesso": {"type": "oauth2"}},
+    "paths": {
+        "/markets/{region_id}/orders/": {
+            "get": {
+                "parameters": [
+                    {"$ref": "#/parameters/datasource"},
+                    {"$ref": "#/parameters/page"},
+                    {
+                        "name": "region_id",
+                        "in": "path",
+                        "required": True,
+                        "type": "integer",
+                    },
+                ]
+            }
+        },
+        "/characters/{character_id}/contacts/": {
+            "delete": {"parameters": []},
+            "get": {
+                "parameters": [
+                    {
+                        "name": "character_id",
+                        "in": "path",
+                        "required": True,
+                        "type": "integer",
+                    }
+                ],
+                "security": [{"evesso": ["esi-characters.read_contacts.v1"]}],
+            },
+            "post": {"parameters": []},
+        },
+        "/characters/{character_id}/multi/": {
+            "get": {
+                "parameters": [],
+                "security": [{"evesso": ["esi-scope-1.v1", "esi-scope-2.v1"]}],
+            }
+        },
+        "/universe/names/": {
+            "post": {
+                "parameters": [
+                    {"name": "ids", "in": "body", "required": True, "schema": {}}
+                ]
+            }
+        },
+    },
+}
+
+
+class TestMetadataLoad(unittest.TestCase):
+    """Tests loading ESIMetadata from a local swagger.json without requesting ESI."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "metadata.json")
+        self.patchers = [
+            mock.patch.object(esi_metadata, "METADATA_PATH", path),
+            mock.patch.object(esi_metadata, "METADATA_ETAG_PATH", path + ".etag"),
+            mock.patch.object(esi_metadata, "METADATA_PICKLE_PATH", path + ".pkl"),
+            mock.patch.object(esi_metadata.requests, "get"),
+            mock.patch.object(esi_metadata, "threading"),
+        ]
+        for p in self.patchers:
+            p.start()
+        self.path = path
+        self.get = esi_metadata.requests.get
+        self.threading = esi_metadata.threading
+        ESIMetadata.reload()
+
+    def tearDown(self):
+        ESIMetadata.reload()
+        for p in reversed(self.patchers):
+            p.stop()
+        self.tmpdir.cleanup()
+
+    def assertNoTempFiles(self):
+        tmp_files = [f for f in os.listdir(self.tmpdir.name) if f.endswith(".tmp")]
+        self.assertEqual(tmp_files, [])
+
+    def write_swagger(self, swagger: dict = SWAGGER):
+        with open(self.path, "w") as f:
+            json.dump(swagger, f)
+
+    def test_shared_metadata(self):
+        """Tests metadata is parsed once and shared by ESIMetadata instances."""
+        self.write_swagger()
+        m1 = ESIMetadata()
+        self.assertEqual(m1["/universe/names/"].request_type, "post")
+        self.get.assert_not_called()  # local file is used
+        self.threading.Thread.assert_called_once_with(
+            target=esi_metadata._refresh_metadata, daemon=True
+        )
+
+        m2 = ESIMetadata()
+        self.assertIn("/universe/names/", m2)
+        self.assertIs(m1._metaParamIndex, m2._metaParamIndex)
+        self.threading.Thread.assert_called_once()  # not loaded again
+
+        # reload() clears shared metadata
+        swagger = json.loads(json.dumps(SWAGGER))
+        swagger["paths"]["/status/"] = {"get": {"parameters": []}}
+        self.write_swagger(swagger)
+        ESIMetadata.reload()
+        m3 = ESIMetadata()
+        self.assertIn("/status/", m3)
+        self.assertNotIn("/status/", m1)
+
+    def test_lazy_load(self):
+        """Tests metadata is loaded on first use, not in ESIMetadata()."""
+        metadata = ESIMetadata()
+        self.assertIsNone(metadata._templates)
+        self.get.assert_not_called()
+
+        self.write_swagger()
+        self.assertIn("/markets/{region_id}/orders/", metadata)
+        self.assertNotIn("/not/a/request/", metadata)
+        self.assertIsNotNone(metadata._templates)
+
+        metadata = ESIMetadata()
+        with self.assertRaises(KeyError):
+            metadata["/not/a/request/"]
+        self.assertIsNotNone(metadata._templates)
+
+    def test_download_missing(self):
+        """Tests metadata is downloaded when local file is missing."""
+        content = json.dumps(SWAGGER).encode()
+        self.get.return_value = FakeResponse(content, headers={"ETag": '"abc"'})
+        metadata = ESIMetadata()
+        self.assertIn("/universe/names/", metadata)
+        self.get.assert_called_once()
+        self.threading.Thread.assert_not_called()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def load_local(self):
+        """Loads metadata from local file in a "new process", which writes the pickle file."""
+        self.write_swagger()
+        ESIMetadata()["/universe/names/"]
+        ESIMetadata.reload()
+        self.assertTrue(os.path.exists(self.path + ".pkl"))
+        return os.stat(self.path).st_mtime_ns
+
+    def test_refresh_not_modified(self):
+        """Tests refresh sends stored ETag and keeps local file on 304."""
+        mtime = self.load_local()
+        with open(self.path + ".etag", "w") as f:
+            f.write('"abc"')
+        self.get.return_value = FakeResponse(status_code=304)
+
+        esi_metadata._refresh_metadata()
+        self.assertEqual(self.get.call_args[1]["headers"], {"If-None-Match": '"abc"'})
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+        self.assertTrue(os.path.exists(self.path + ".pkl"))
+        self.assertNoTempFiles()
+
+    def test_refresh_modified(self):
+        """Tests refresh rewrites local file, ETag, and removes pickle on 200."""
+        self.load_local()
+        with open(self.path + ".etag", "w") as f:
+            f.write('"abc"')
+        swagger = json.loads(json.dumps(SWAGGER))
+        swagger["paths"]["/status/"] = {"get": {"parameters": []}}
+        content = json.dumps(swagger).encode()
+        self.get.return_value = FakeResponse(content, headers={"ETag": '"def"'})
+
+        esi_metadata._refresh_metadata()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        with open(self.path + ".etag") as f:
+            self.assertEqual(f.read(), '"def"')
+        self.assertFalse(os.path.exists(self.path + ".pkl"))
+        self.assertIn("/status/", ESIMetadata())
+
+    def test_refresh_unchanged_without_etag(self):
+        """Tests refresh keeps local file and pickle if content is the same."""
+        mtime = self.load_local()
+        content = json.dumps(SWAGGER).encode()
+        self.get.return_value = FakeResponse(content)
+
+        esi_metadata._refresh_metadata()
+        self.assertEqual(self.get.call_args[1]["headers"], {})
+        self.assertEqual(os.stat(self.path).st_mtime_ns, mtime)
+        self.assertTrue(os.path.exists(self.path + ".pkl"))
+        self.assertNoTempFiles()
+
+    def test_pickle(self):
+        """Tests parsed requests are loaded from pickle file in a new process."""
+        self.load_local()
+        with open(self.path + ".pkl", "rb") as f:
+            pickled = pickle.load(f)
+        self.assertNotIn("paths", pickled)
+        self.assertEqual(pickled["stamp"][0], esi_metadata._PICKLE_FORMAT)
+
+        with mock.patch.object(
+            ESIMetadata, "_parse_metadata_file", autospec=True
+        ) as parse:
+            metadata = ESIMetadata()
+            api_request = metadata["/markets/{region_id}/orders/"]
+            parse.assert_not_called()
+        self.assertEqual(
+            [p.name for p in api_request.parameters],
+            ["datasource", "page", "region_id"],
+        )
+        self.assertEqual(api_request.parameters["page"].default, 1)
+        self.assertEqual(
+            metadata["/characters/{character_id}/contacts/"].security,
+            ["esi-characters.read_contacts.v1"],
+        )
+        self.assertIn("/characters/{character_id}/multi/", metadata)
+        with self.assertRaises(ValueError):
+            metadata["/characters/{character_id}/multi/"]
+        self.assertEqual(metadata.paths, SWAGGER["paths"])  # parsed on access
+
+    def test_paths_after_refresh(self):
+        """Tests paths matches parsed requests if local file is refreshed after loading pickle."""
+        self.load_local()
+        metadata = ESIMetadata()
+        self.assertNotIn("/status/", metadata)  # loaded from pickle
+
+        swagger = json.loads(json.dumps(SWAGGER))
+        swagger["paths"]["/status/"] = {"get": {"parameters": []}}
+        self.write_swagger(swagger)  # refreshed by another process
+        self.assertEqual(metadata.paths, swagger["paths"])
+        self.assertIn("/status/", metadata)
+        self.assertIn("/status/", ESIMetadata())
+
+    def test_pickle_failure_logged(self):
+        """Tests failing to save pickle file is logged and does not fail loading."""
+        self.write_swagger()
+        with mock.patch.object(
+            esi_metadata.pickle, "dump", side_effect=OSError("disk full")
+        ), self.assertLogs(esi_metadata.logger, level="WARNING"):
+            self.assertIn("/universe/names/", ESIMetadata())
+        self.assertFalse(os.path.exists(self.path + ".pkl"))
+        self.assertNoTempFiles()
+
+    def test_pickle_invalidated(self):
+        """Tests pickle file is ignored if local file or pickle format changes."""
+        self.load_local()
+        swagger = json.loads(json.dumps(SWAGGER))
+        swagger["paths"]["/status/"] = {"get": {"parameters": []}}
+        self.write_swagger(swagger)  # rewritten without removing pickle
+
+        parse_metadata_file = ESIMetadata._parse_metadata_file
+        with mock.patch.object(
+            ESIMetadata,
+            "_parse_metadata_file",
+            autospec=True,
+            side_effect=parse_metadata_file,
+        ) as parse:
+            self.assertIn("/status/", ESIMetadata())
+            parse.assert_called_once()
+
+            ESIMetadata.reload()
+            self.assertIn("/status/", ESIMetadata())  # new pickle is used
+            parse.assert_called_once()
+
+            ESIMetadata.reload()
+            with mock.patch.object(esi_metadata, "_PICKLE_FORMAT", 0):
+                self.assertIn("/status/", ESIMetadata())
+            self.assertEqual(parse.call_count, 2)
+
+    def parsers(self):
+        """Yields names of available parsers, with _parse_metadata patched to use it."""
+        ijson = esi_metadata.ijson
+        if esi_metadata.orjson is not None:
+            yield "orjson"
+        with mock.patch.object(esi_metadata, "orjson", None):
+            if ijson is not None and ijson.backend == "yajl2_c":
+                yield "ijson"
+            with mock.patch.object(esi_metadata, "ijson", None):
+                yield "json"
+
+    def test_parse_metadata(self):
+        """Tests _parse_metadata gives the same metadata with orjson, ijson, and json."""
+        self.write_swagger()
+        for parser in self.parsers():
+            with self.subTest(parser=parser):
+                with open(self.path, "rb") as f:
+                    metadata = esi_metadata._parse_metadata(f)
+                for field_ in esi_metadata.METADATA_FIELDS:
+                    self.assertEqual(metadata[field_], SWAGGER[field_])
+
+        for content in [b"", b'{"paths": {"/status/": ']:
+            with open(self.path, "wb") as f:
+                f.write(content)
+            for parser in self.parsers():
+                with self.subTest(parser=parser, content=content):
+                    with open(self.path, "rb") as f, self.assertRaises(ValueError):
+                        esi_metadata._parse_metadata(f)
+
+    def test_invalid_local_file(self):
+        """Tests invalid local file is downloaded again instead of failing every load."""
+        with open(self.path, "wb") as f:
+            f.write(b'{"paths": {"/status/": ')
+        content = json.dumps(SWAGGER).encode()
+        self.get.return_value = FakeResponse(content)
+
+        with self.assertLogs(esi_metadata.logger, level="WARNING"):
+            metadata = ESIMetadata()
+            self.assertIn("/universe/names/", metadata)
+        self.get.assert_called_once()
+        self.threading.Thread.assert_not_called()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+
+    def test_refresh_failure_logged(self):
+        """Tests background refresh logs errors and keeps local file."""
+        self.write_swagger()
+        self.get.side_effect = ConnectionError("no network")
+        with self.assertLogs(esi_metadata.logger, level="WARNING"):
+            esi_metadata._refresh_metadata()
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), SWAGGER)
+        self.assertNoTempFiles()
+
+
 class TestSSO(unittest.TestCase):
     def test_pc_copy(self):
         # Testing check_call and other cmd are not necessary.
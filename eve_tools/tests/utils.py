@@ -1,6 +1,7 @@
 import asyncio
 from inspect import iscoroutinefunction
 import os
+import requests
 import yaml
 from typing import Callable, Coroutine, Union
 
@@ -40,3 +41,28 @@ def request_from_ESI(esi_func: Union[Callable, Coroutine], *args, **kwd):
     else:
         raise NotImplemented
     return resp
+
+
+class FakeResponse:
+    """A stand-in for requests.Response used with requests.get(..., stream=True)."""
+
+    def __init__(
+        self, content: bytes = b"", status_code: int = 200, headers: dict = None
+    ):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error")
+
+    def iter_content(self, chunk_size: int = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
@@ -25,6 +25,10 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=install_requirements,
+    extras_require={
+        "orjson": ["orjson"],  # faster ESI metadata parsing
+        "ijson": ["ijson"],  # streaming ESI metadata parsing if orjson is not installed
+    },
     license="BSD 3-Clause License",
     keywords=["python", "esi", "eveonline"],
     classifiers=[